@@ -1,19 +1,63 @@
 from fastapi import APIRouter, File, UploadFile, HTTPException, Depends, Query
 from fastapi.responses import StreamingResponse
-from typing import List
-import pandas as pd
-from io import BytesIO
+from typing import Dict, List, Tuple
+from io import BytesIO, StringIO, TextIOWrapper
+import asyncio
+import csv
+import hashlib
 import logging
 
-from app.services.text_processor import TextProcessor
-from app.services.llm_service import ResumeAnalyzer
-from app.models.resume import CriteriaResponse, ErrorResponse
+from app.services.text_processor import TextProcessor, get_text_processor
+from app.services.llm_service import ResumeAnalyzer, get_analyzer
+from app.models.resume import BatchJob, CriteriaResponse, ErrorResponse
 from app.core.config import get_settings
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 settings = get_settings()
 
+UPLOAD_DESCRIPTION = "PDF or DOCX document. Accepted types: " + ", ".join(settings.ALLOWED_MIME_TYPES)
+
+CANDIDATE_COLUMNS = ["Name", "Experience", "Current Role", "Education", "Skills"]
+
+def _csv_fieldnames(requirements: List[str]) -> List[str]:
+    """Column order for the scoring CSV"""
+    return CANDIDATE_COLUMNS + [f"Score - {req}" for req in requirements] + ["Total Score"]
+
+def _build_row(candidate: Dict[str, str], scores: Dict[str, int], requirements: List[str]) -> dict:
+    """Combine candidate info and scores into a CSV row"""
+    row = {
+        "Name": candidate["name"],
+        "Experience": candidate["experience"],
+        "Current Role": candidate["current_role"],
+        "Education": candidate["education"],
+        "Skills": candidate["skills"]
+    }
+    
+    # Add individual scores
+    for req in requirements:
+        row[f"Score - {req}"] = scores.get(req, 0)
+    row["Total Score"] = scores.get("total_score", 0)
+    return row
+
+def _sorted_csv_response(results: List[dict], fieldnames: List[str]) -> StreamingResponse:
+    """CSV attachment with rows sorted by total score"""
+    results.sort(key=lambda r: r["Total Score"], reverse=True)
+    
+    output = BytesIO()
+    wrapper = TextIOWrapper(output, encoding="utf-8", newline="")
+    writer = csv.DictWriter(wrapper, fieldnames=fieldnames)
+    writer.writeheader()
+    writer.writerows(results)
+    wrapper.detach()  # Flush and keep the buffer open
+    output.seek(0)
+    
+    return StreamingResponse(
+        output,
+        media_type="text/csv",
+        headers={"Content-Disposition": "attachment; filename=resume_scores.csv"}
+    )
+
 @router.post(
     "/extract-criteria",
     response_model=CriteriaResponse,
@@ -23,20 +67,20 @@ settings = get_settings()
     }
 )
 async def extract_criteria(
-    file: UploadFile = File(...),
-    text_processor: TextProcessor = Depends(TextProcessor),
-    analyzer: ResumeAnalyzer = Depends(ResumeAnalyzer)
+    file: UploadFile = File(..., description=UPLOAD_DESCRIPTION),
+    text_processor: TextProcessor = Depends(get_text_processor),
+    analyzer: ResumeAnalyzer = Depends(get_analyzer)
 ):
     """Extract key requirements from a job description"""
     try:
-        await text_processor.validate_file(file)
-        text = await text_processor.extract_text(file)
+        content, kind = await text_processor.validate_and_read(file)
+        text = await asyncio.to_thread(text_processor.extract_text_from_bytes, content, kind)
         requirements = await analyzer.extract_requirements(text)
         return CriteriaResponse(criteria=requirements)
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Failed to process job description: {e}")
+        logger.error("Failed to process job description: %s", e)
         raise HTTPException(500, "Failed to process job description")
 
 @router.post(
@@ -48,10 +92,11 @@ async def extract_criteria(
     }
 )
 async def score_resumes(
-    files: List[UploadFile] = File(...),
+    files: List[UploadFile] = File(..., description=UPLOAD_DESCRIPTION),
     requirements: List[str] = Query(...),
-    text_processor: TextProcessor = Depends(TextProcessor),
-    analyzer: ResumeAnalyzer = Depends(ResumeAnalyzer)
+    sort: bool = Query(True, alias="sorted", description="Sort by total score. Set to false to stream rows as each resume finishes."),
+    text_processor: TextProcessor = Depends(get_text_processor),
+    analyzer: ResumeAnalyzer = Depends(get_analyzer)
 ):
     """Score multiple resumes against requirements"""
     try:
@@ -61,55 +106,173 @@ async def score_resumes(
         if len(files) > settings.MAX_FILES:
             raise HTTPException(400, f"Too many files. Maximum is {settings.MAX_FILES}")
 
-        results = []
+        fieldnames = _csv_fieldnames(requirements)
+
+        # Read uploads up front, they are closed before a streamed response runs.
+        # Identical files are grouped by content hash and only analyzed once.
+        uploads: Dict[bytes, Tuple[bytes, str, List[str]]] = {}
         for resume in files:
             try:
-                await text_processor.validate_file(resume)
-                text = await text_processor.extract_text(resume)
-                
-                # Get candidate info and scores
-                candidate = await analyzer.get_candidate_info(text)
-                scores = await analyzer.score_resume(text, requirements)
-                
-                # Combine results
-                result = {
-                    "Name": candidate["name"],
-                    "Experience": candidate["experience"],
-                    "Current Role": candidate["current_role"],
-                    "Education": candidate["education"],
-                    "Skills": candidate["skills"]
-                }
-                
-                # Add individual scores
-                for req in requirements:
-                    result[f"Score - {req}"] = scores.get(req, 0)
-                result["Total Score"] = scores.get("total_score", 0)
-                
-                results.append(result)
-                
-            except Exception as e:
-                logger.warning(f"Failed to process {resume.filename}: {e}")
+                content, kind = await text_processor.validate_and_read(resume)
+            except HTTPException as e:
+                logger.warning("Skipping %s: %s", resume.filename, e.detail)
                 continue
+            key = hashlib.sha256(content).digest()
+            if key in uploads:
+                uploads[key][2].append(resume.filename)
+            else:
+                uploads[key] = (content, kind, [resume.filename])
+
+        if not uploads:
+            raise HTTPException(400, "No valid resumes to process")
+
+        async def _process_one(content: bytes, kind: str, filenames: List[str]) -> List[dict]:
+            try:
+                text = await asyncio.to_thread(text_processor.extract_text_from_bytes, content, kind)
+            except Exception as e:
+                logger.warning("Failed to extract text from %s: %s", filenames, e)
+                return []
+
+            # Get candidate info and scores
+            try:
+                candidate, scores = await analyzer.analyze(text, requirements)
+            except HTTPException:
+                # The AI service is unavailable, which isn't a problem with this file
+                raise
+            except Exception as e:
+                logger.warning("Failed to analyze %s: %s", filenames, e)
+                return []
+            return [_build_row(candidate, scores, requirements) for _ in filenames]
+
+        tasks = [asyncio.ensure_future(_process_one(*upload)) for upload in uploads.values()]
+
+        if not sort:
+            pending = asyncio.as_completed(tasks)
+            try:
+                # Wait for the first resume, so an outage is a 503 rather than an empty CSV
+                first_rows = await next(pending)
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                raise
+
+            async def _stream_rows():
+                buffer = StringIO()
+                writer = csv.DictWriter(buffer, fieldnames=fieldnames)
+                writer.writeheader()
+                writer.writerows(first_rows)
+                yield buffer.getvalue()
+
+                try:
+                    for next_result in pending:
+                        try:
+                            rows = await next_result
+                        except HTTPException as e:
+                            # Headers are already sent, end the CSV early
+                            logger.error("Stopping stream: %s", e.detail)
+                            return
+                        if rows:
+                            buffer.seek(0)
+                            buffer.truncate(0)
+                            writer.writerows(rows)
+                            yield buffer.getvalue()
+                finally:
+                    for task in tasks:
+                        task.cancel()
+
+            return StreamingResponse(
+                _stream_rows(),
+                media_type="text/csv",
+                headers={"Content-Disposition": "attachment; filename=resume_scores.csv"}
+            )
+
+        try:
+            results = [row for rows in await asyncio.gather(*tasks) for row in rows]
+        finally:
+            for task in tasks:
+                task.cancel()
 
         if not results:
             raise HTTPException(400, "No valid resumes to process")
 
-        # Create CSV response
-        df = pd.DataFrame(results)
-        df = df.sort_values("Total Score", ascending=False)
+        return _sorted_csv_response(results, fieldnames)
         
-        output = BytesIO()
-        df.to_csv(output, index=False, encoding="utf-8")
-        output.seek(0)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error("Resume scoring failed: %s", e)
+        raise HTTPException(500, "Failed to process resumes")
+
+@router.post(
+    "/score-resumes-batch",
+    response_model=BatchJob,
+    responses={
+        400: {"model": ErrorResponse},
+        500: {"model": ErrorResponse}
+    }
+)
+async def score_resumes_batch(
+    files: List[UploadFile] = File(..., description=UPLOAD_DESCRIPTION),
+    requirements: List[str] = Query(...),
+    text_processor: TextProcessor = Depends(get_text_processor),
+    analyzer: ResumeAnalyzer = Depends(get_analyzer)
+):
+    """Queue resume scoring as an OpenAI batch job, for large offline runs"""
+    try:
+        if not requirements:
+            raise HTTPException(400, "No requirements provided")
+            
+        if len(files) > settings.MAX_FILES:
+            raise HTTPException(400, f"Too many files. Maximum is {settings.MAX_FILES}")
+
+        texts = []
+        for resume in files:
+            try:
+                content, kind = await text_processor.validate_and_read(resume)
+                texts.append(await asyncio.to_thread(text_processor.extract_text_from_bytes, content, kind))
+            except HTTPException as e:
+                logger.warning("Skipping %s: %s", resume.filename, e.detail)
+
+        if not texts:
+            raise HTTPException(400, "No valid resumes to process")
+
+        batch = await analyzer.submit_batch(texts, requirements)
+        return BatchJob(batch_id=batch.id, status=batch.status)
         
-        return StreamingResponse(
-            output,
-            media_type="text/csv",
-            headers={"Content-Disposition": "attachment; filename=resume_scores.csv"}
-        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error("Batch submission failed: %s", e)
+        raise HTTPException(500, "Failed to submit resumes")
+
+@router.get(
+    "/batch-status/{batch_id}",
+    response_model=BatchJob,
+    responses={
+        200: {"content": {"text/csv": {}}},
+        404: {"model": ErrorResponse},
+        500: {"model": ErrorResponse}
+    }
+)
+async def batch_status(
+    batch_id: str,
+    analyzer: ResumeAnalyzer = Depends(get_analyzer)
+):
+    """Check a batch job, returning the scores CSV once it has completed"""
+    try:
+        batch = await analyzer.get_batch(batch_id)
+        if batch.status != "completed":
+            return BatchJob(batch_id=batch.id, status=batch.status)
+
+        requirements, batch_results = await analyzer.get_batch_results(batch)
+        results = [_build_row(candidate, scores, requirements) for candidate, scores in batch_results]
+        if not results:
+            raise HTTPException(500, "Batch completed without valid results")
+
+        return _sorted_csv_response(results, _csv_fieldnames(requirements))
         
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Resume scoring failed: {e}")
-        raise HTTPException(500, "Failed to process resumes")
+        logger.error("Batch status check failed: %s", e)
+        raise HTTPException(500, "Failed to check batch status")
@@ -1,6 +1,6 @@
 from pydantic_settings import BaseSettings
 from functools import lru_cache
-from typing import List
+from typing import List, Optional
 import os
 from dotenv import load_dotenv
 
@@ -12,12 +12,18 @@ class Settings(BaseSettings):
     OPENAI_API_KEY: str = os.getenv("OPENAI_API_KEY", "")
     MAX_FILES: int = 20
     MAX_CRITERIA: int = 15
+    MAX_CONCURRENCY: int = 5
+    MAX_RESUME_TOKENS: int = 1500
+    MAX_JD_TOKENS: int = 2500
+    # Listed in the API docs; uploads themselves are validated by their magic bytes
     ALLOWED_MIME_TYPES: dict = {
         "application/pdf": "pdf",
         "application/vnd.openxmlformats-officedocument.wordprocessingml.document": "docx"
     }
     CORS_ORIGINS: List[str] = ["*"]
-    MODEL_NAME: str = "gpt-3.5-turbo-0125"
+    MODEL_NAME: str = "gpt-4o-mini"  # Must support structured outputs
+    CACHE_DIR: Optional[str] = None
+    LOG_LEVEL: str = "INFO"
 
 @lru_cache()
 def get_settings() -> Settings:
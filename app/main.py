@@ -1,9 +1,11 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 import logging
 
 from app.api.endpoints import router
 from app.core.config import get_settings
+from app.services.llm_service import load_encoding
 
 # Configure logging
 logging.basicConfig(
@@ -12,9 +14,17 @@ logging.basicConfig(
 )
 
 settings = get_settings()
+logging.getLogger("app").setLevel(settings.LOG_LEVEL)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Fail at startup rather than retrying the download on every request
+    await load_encoding()
+    yield
 
 app = FastAPI(
     title=settings.PROJECT_NAME,
+    lifespan=lifespan,
     openapi_url=f"{settings.API_V1_STR}/openapi.json",
     docs_url="/docs",
     redoc_url="/redoc"
@@ -1,5 +1,6 @@
-from pydantic import BaseModel
-from typing import List, Dict, Optional
+from functools import lru_cache
+from pydantic import BaseModel, create_model
+from typing import List, Dict, Literal, Optional, Tuple, Type
 
 class CriteriaResponse(BaseModel):
     """Response model for extracted job criteria"""
@@ -19,6 +20,43 @@ class ResumeScore(BaseModel):
     requirement_scores: Dict[str, int]
     total_score: int
 
+class CandidateExtract(BaseModel):
+    """Structured output schema for candidate information"""
+    name: str
+    years_experience: str
+    current_job: str
+    skills: str
+    education: str
+
+class RequirementList(BaseModel):
+    """Structured output schema for extracted job requirements"""
+    requirements: List[str]
+
+class RequirementScore(BaseModel):
+    """Structured output schema for a single requirement score"""
+    requirement: str
+    score: int
+
+class ResumeAnalysis(BaseModel):
+    """Structured output schema for candidate info and scores in one call"""
+    candidate: CandidateExtract
+    scores: List[RequirementScore]
+
+@lru_cache(maxsize=32)
+def analysis_model(requirements: Tuple[str, ...]) -> Type[ResumeAnalysis]:
+    """ResumeAnalysis whose scores can only name the given requirements"""
+    score_model = create_model(
+        "RequirementScore",
+        __base__=RequirementScore,
+        requirement=(Literal[requirements], ...)
+    )
+    return create_model("ResumeAnalysis", __base__=ResumeAnalysis, scores=(List[score_model], ...))
+
+class BatchJob(BaseModel):
+    """Model for a queued batch scoring job"""
+    batch_id: str
+    status: str
+
 class ErrorResponse(BaseModel):
     """Model for error responses"""
     detail: str
@@ -0,0 +1,63 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+class ResponseCache:
+    """Disk cache for LLM responses, keyed by a hash of the model, prompt version and messages"""
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(model: str, prompt_version: str, messages: List[Dict], response_format: str = "text") -> str:
+        """Build a content-addressable key from the request inputs"""
+        fields = [model, prompt_version, response_format]
+        for message in messages:
+            fields.extend([message["role"], message["content"]])
+
+        # Length-prefix each field so different splits can't collide
+        parts = [len(f.encode("utf-8")).to_bytes(8, "big") + f.encode("utf-8") for f in fields]
+        return hashlib.sha256(b"\x00".join(parts)).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached content, or None on a miss"""
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+            return entry["content"]
+        except Exception as e:
+            logger.warning("Evicting corrupt cache entry %s: %s", key, e)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+    def set(self, key: str, content: str, model: str) -> None:
+        """Atomically write a response to the cache"""
+        entry = {
+            "content": content,
+            "model": model,
+            "created_at": datetime.now(timezone.utc).isoformat()
+        }
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            logger.warning("Failed to write cache entry %s: %s", key, e)
@@ -1,166 +1,364 @@
 import logging
 import json
-import time
-from typing import List, Dict
-from openai import OpenAI
+import regex
+import asyncio
+from functools import lru_cache
+from typing import Any, Callable, List, Dict, Optional, Tuple, Type
+import tiktoken
+from openai import AsyncOpenAI, ContentFilterFinishReasonError, LengthFinishReasonError, NotFoundError
+from openai.types import Batch
 from fastapi import HTTPException
+from pydantic import BaseModel, ValidationError
 from app.core.config import get_settings
+from app.models.resume import CandidateExtract, RequirementList, RequirementScore, analysis_model
+from app.services.cache import ResponseCache
 
 logger = logging.getLogger(__name__)
 settings = get_settings()
 
+# Bump when prompts change so cached responses are not reused
+PROMPT_VERSION = "4"
+
+# Prompts are kept static (no interpolation) so they form a stable prefix
+# for OpenAI prompt caching; per-request content goes in later messages.
+SCORING_RUBRIC = """Score 0-5 where:
+0: No match
+1: Basic/entry level
+2: Some experience
+3: Meets requirement
+4: Exceeds requirement
+5: Expert level
+Return one score per requirement, using the requirements exactly as given."""
+
+ANALYSIS_SYSTEM = (
+    "Extract candidate information from the resume and score how well the candidate "
+    "meets each requirement. Be precise and factual.\n" + SCORING_RUBRIC
+)
+
+REQUIREMENTS_SYSTEM = (
+    "Extract specific, measurable job requirements. Focus on technical skills, experience, "
+    "and qualifications. List the main requirements from the job post."
+)
+
+# Prefix of the message carrying the requirements, also used to read them back from batch input
+_REQUIREMENTS_PREFIX = "Requirements:\n"
+
+# Raised by beta.chat.completions.parse when the request succeeded but the
+# output can't be used; handled like other invalid output, not retried blindly
+_OUTPUT_ERRORS = (LengthFinishReasonError, ContentFilterFinishReasonError, ValidationError)
+
+# At least first and last name, each starting with a letter that isn't
+# lowercase (names in scripts without case pass); initials are allowed.
+# Uses the regex module, as re has no Unicode lowercase class.
+_NAME_WORD = r"(?!\p{Ll})\p{L}[\p{L}\p{M}]*(?:['-]\p{L}[\p{L}\p{M}]*)*\.?"
+_NAME_RE = regex.compile(rf"^{_NAME_WORD}(?:\s+{_NAME_WORD})+$")
+
+def _strict_schema(schema: Dict[str, Any]) -> Dict[str, Any]:
+    """Apply structured outputs strict-mode rules to a JSON schema, recursively"""
+    strict = {}
+    for key, value in schema.items():
+        if key == "default":
+            continue
+        if key in ("properties", "$defs"):
+            value = {name: _strict_schema(sub) for name, sub in value.items()}
+        elif key in ("items", "additionalProperties") and isinstance(value, dict):
+            value = _strict_schema(value)
+        elif key in ("anyOf", "allOf"):
+            value = [_strict_schema(sub) for sub in value]
+        strict[key] = value
+
+    if strict.get("type") == "object":
+        strict["additionalProperties"] = False
+        strict["required"] = list(strict.get("properties", {}))
+    return strict
+
+def _response_format(model: Type[BaseModel]) -> Dict[str, Any]:
+    """json_schema response_format for a model, for requests built by hand (batch)"""
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": model.__name__,
+            "schema": _strict_schema(model.model_json_schema()),
+            "strict": True
+        }
+    }
+
+@lru_cache()
+def _get_encoding() -> "tiktoken.Encoding":
+    """Tokenizer for the configured model, loaded once"""
+    try:
+        return tiktoken.encoding_for_model(settings.MODEL_NAME)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+async def load_encoding() -> None:
+    """Load the tokenizer at startup, off the event loop, since the first load downloads it"""
+    await asyncio.to_thread(_get_encoding)
+
 class ResumeAnalyzer:
     def __init__(self):
         if not settings.OPENAI_API_KEY:
             raise ValueError("OpenAI API key not found")
-        self.client = OpenAI(api_key=settings.OPENAI_API_KEY)
+        self.client = AsyncOpenAI(api_key=settings.OPENAI_API_KEY)
+        self.cache = ResponseCache(settings.CACHE_DIR) if settings.CACHE_DIR else None
+        # Shared by every request using this analyzer, to stay within OpenAI rate limits
+        self._semaphore = asyncio.Semaphore(settings.MAX_CONCURRENCY)
+
+    async def _call_openai(
+        self,
+        messages: List[Dict],
+        response_model: Optional[Type[BaseModel]] = None,
+        validator: Optional[Callable[[Any], Any]] = None
+    ) -> Any:
+        """Simple wrapper for OpenAI API calls with retries and optional disk cache
+
+        With a response_model the model is constrained to that schema and the
+        parsed object is returned. If a validator is given, its return value is
+        returned instead. When it raises, the error is sent back to the model so
+        it can fix its output.
+        """
+        response_format = response_model.__name__ if response_model else "text"
+        cache_key = None
+        if self.cache:
+            cache_key = self.cache.make_key(settings.MODEL_NAME, PROMPT_VERSION, messages, response_format)
+            # Disk I/O, kept off the event loop
+            cached = await asyncio.to_thread(self.cache.get, cache_key)
+            if cached is not None:
+                try:
+                    result = response_model.model_validate_json(cached) if response_model else cached
+                    return validator(result) if validator else result
+                except Exception as e:
+                    logger.warning("Ignoring invalid cached response: %s", e)
 
-    def _call_openai(self, messages: List[Dict], json_response: bool = False) -> str:
-        """Simple wrapper for OpenAI API calls with retries"""
         max_retries = 3
+        max_fix_attempts = 2
         wait_time = 1  # seconds
+        attempt = 0
+        fix_attempt = 0
+        messages = list(messages)
 
-        for attempt in range(max_retries):
+        while True:
+            output_error = None
             try:
-                response = self.client.chat.completions.create(
-                    model=settings.MODEL_NAME,
-                    messages=messages,
-                    temperature=0.1,
-                    response_format={"type": "json_object"} if json_response else None,
-                    timeout=30
-                )
-                return response.choices[0].message.content.strip()
-
+                async with self._semaphore:
+                    if response_model:
+                        response = await self.client.beta.chat.completions.parse(
+                            model=settings.MODEL_NAME,
+                            messages=messages,
+                            temperature=0.1,
+                            response_format=response_model,
+                            timeout=30
+                        )
+                    else:
+                        response = await self.client.chat.completions.create(
+                            model=settings.MODEL_NAME,
+                            messages=messages,
+                            temperature=0.1,
+                            timeout=30
+                        )
+                message = response.choices[0].message
+            except _OUTPUT_ERRORS as e:
+                completion = getattr(e, "completion", None)
+                message = completion.choices[0].message if completion else None
+                output_error = e
             except Exception as e:
-                if attempt == max_retries - 1:
-                    logger.error(f"OpenAI API failed: {e}")
+                attempt += 1
+                if attempt == max_retries:
+                    logger.error("OpenAI API failed: %s", e)
                     raise HTTPException(status_code=503, detail="AI service unavailable")
-                time.sleep(wait_time * (attempt + 1))
+                await asyncio.sleep(wait_time * attempt)
+                continue
+
+            content = ((message.content if message else None) or "").strip()
+            try:
+                if output_error:
+                    raise output_error
+                if response_model:
+                    if message.parsed is None:
+                        raise ValueError(message.refusal or "No structured output returned")
+                    result = message.parsed
+                else:
+                    result = content
+                if validator:
+                    result = validator(result)
+            except Exception as e:
+                if fix_attempt == max_fix_attempts:
+                    raise
+                fix_attempt += 1
+                logger.warning("Invalid model output, asking for a fix: %s", e)
+                messages += [
+                    {"role": "assistant", "content": content},
+                    {"role": "user", "content": f"Your output had error: {e}. Fix it and try again."}
+                ]
+                await asyncio.sleep(wait_time * fix_attempt)
+                continue
+
+            if cache_key:
+                await asyncio.to_thread(self.cache.set, cache_key, content, settings.MODEL_NAME)
+            return result
+
+    def _truncate(self, text: str, max_tokens: int) -> str:
+        """Cut text down to at most max_tokens tokens"""
+        enc = _get_encoding()
+        # Resumes are untrusted text; treat strings like <|endoftext|> as plain text
+        ids = enc.encode_ordinary(text)
+        if len(ids) <= max_tokens:
+            return text
+        return enc.decode(ids[:max_tokens])
 
     def _clean_name(self, name: str) -> str:
         """Clean and validate candidate name"""
-        if not name or len(name.split()) < 2:
-            return "Unknown Candidate"
-            
-        # Check if name has at least first and last name
-        name_parts = name.strip().split()
-        if len(name_parts) < 2:
-            return "Unknown Candidate"
-            
-        # Validate each part is a proper name
-        for part in name_parts:
-            if not part.isalpha() or not part[0].isupper():
-                return "Unknown Candidate"
-                
-        return " ".join(name_parts)
-
-    async def get_candidate_info(self, resume_text: str) -> Dict[str, str]:
-        """Extract basic info from resume"""
-        messages = [
-            {
-                "role": "system",
-                "content": "Extract candidate information from resumes. Be precise and factual."
-            },
-            {
-                "role": "user",
-                "content": f"Get candidate info from this resume. Return JSON with: name, years_experience, current_job, skills, education.\n\n{resume_text[:3000]}"
-            }
+        name = (name or "").strip()
+        return name if _NAME_RE.match(name) else "Unknown Candidate"
+
+    def _parse_candidate(self, info: CandidateExtract) -> Dict[str, str]:
+        """Clean and validate candidate info returned by the model"""
+        return {
+            "name": self._clean_name(info.name),
+            "experience": info.years_experience or "Not specified",
+            "current_role": info.current_job or "Not specified",
+            "skills": info.skills or "Not specified",
+            "education": info.education or "Not specified"
+        }
+
+    def _parse_scores(self, requirement_scores: List[RequirementScore], job_requirements: List[str]) -> Dict[str, int]:
+        """Clamp model scores to 0-5 and add the total"""
+        raw_scores = {item.requirement: item.score for item in requirement_scores}
+        unknown = set(raw_scores) - set(job_requirements)
+        if unknown:
+            logger.warning("Ignoring scores for unknown requirements: %s", sorted(unknown))
+        missing = [req for req in job_requirements if req not in raw_scores]
+        if missing:
+            logger.warning("No score returned for requirements, using 0: %s", missing)
+        scores = {req: min(5, max(0, raw_scores.get(req, 0))) for req in job_requirements}
+        scores["total_score"] = sum(scores[req] for req in job_requirements)
+        return scores
+
+    def _clean_requirements(self, data: RequirementList) -> List[str]:
+        """Clean requirements, raising if none are usable"""
+        reqs = []
+        for req in data.requirements[:settings.MAX_CRITERIA]:
+            if len(req.strip()) > 10:
+                reqs.append(req.strip())
+        
+        if not reqs:
+            raise ValueError("No valid requirements found")
+        
+        return reqs
+
+    def _analysis_messages(self, resume_text: str, job_requirements: List[str]) -> List[Dict]:
+        """Instructions, then requirements, then the resume, so the prefix shared by a request is cacheable"""
+        return [
+            {"role": "system", "content": ANALYSIS_SYSTEM},
+            {"role": "user", "content": _REQUIREMENTS_PREFIX + json.dumps(job_requirements)},
+            {"role": "user", "content": f"Resume:\n{self._truncate(resume_text, settings.MAX_RESUME_TOKENS)}"}
         ]
 
+    async def analyze(self, resume_text: str, job_requirements: List[str]) -> Tuple[Dict[str, str], Dict[str, int]]:
+        """Extract candidate info and score requirements in a single call"""
+        messages = self._analysis_messages(resume_text, job_requirements)
+        data = await self._call_openai(messages, response_model=analysis_model(tuple(job_requirements)))
+        return self._parse_candidate(data.candidate), self._parse_scores(data.scores, job_requirements)
+
+    async def submit_batch(self, resume_texts: List[str], job_requirements: List[str]) -> Batch:
+        """Queue resume analysis as an OpenAI batch job"""
+        response_format = _response_format(analysis_model(tuple(job_requirements)))
+        lines = []
+        for i, resume_text in enumerate(resume_texts):
+            lines.append(json.dumps({
+                "custom_id": f"resume-{i}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": settings.MODEL_NAME,
+                    "messages": self._analysis_messages(resume_text, job_requirements),
+                    "temperature": 0.1,
+                    "response_format": response_format
+                }
+            }))
+
+        try:
+            batch_file = await self.client.files.create(
+                file=("resume_batch.jsonl", "\n".join(lines).encode("utf-8")),
+                purpose="batch"
+            )
+            return await self.client.batches.create(
+                input_file_id=batch_file.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h"
+            )
+        except Exception as e:
+            logger.error("Failed to submit batch: %s", e)
+            raise HTTPException(status_code=503, detail="AI service unavailable")
+
+    async def get_batch(self, batch_id: str) -> Batch:
+        """Look up an OpenAI batch job"""
         try:
-            response = self._call_openai(messages, json_response=True)
-            info = json.loads(response)
-            
-            # Clean and validate the data
-            return {
-                "name": self._clean_name(info.get("name", "")),
-                "experience": info.get("years_experience", "Not specified"),
-                "current_role": info.get("current_job", "Not specified"),
-                "skills": info.get("skills", "Not specified"),
-                "education": info.get("education", "Not specified")
-            }
+            return await self.client.batches.retrieve(batch_id)
+        except NotFoundError:
+            raise HTTPException(status_code=404, detail="Batch not found")
         except Exception as e:
-            logger.error(f"Failed to extract candidate info: {e}")
-            return {
-                "name": "Unknown Candidate",
-                "experience": "Not specified",
-                "current_role": "Not specified",
-                "skills": "Not specified",
-                "education": "Not specified"
-            }
-
-    async def score_resume(self, resume_text: str, job_requirements: List[str]) -> Dict[str, int]:
-        """Score resume against job requirements"""
-        scores = {}
-        total = 0
-
-        # Get candidate background first
-        candidate = await self.get_candidate_info(resume_text)
-        
-        for req in job_requirements:
-            messages = [
-                {
-                    "role": "system",
-                    "content": f"""Score this requirement for candidate: {candidate['name']}
-                    Background: {candidate['experience']} experience, {candidate['current_role']}
-                    Score 0-5 where:
-                    0: No match
-                    1: Basic/entry level
-                    2: Some experience
-                    3: Meets requirement
-                    4: Exceeds requirement
-                    5: Expert level
-                    Return only the score number."""
-                },
-                {
-                    "role": "user",
-                    "content": f"Requirement: {req}\n\nResume:\n{resume_text[:5000]}"
-                }
-            ]
+            logger.error("Failed to retrieve batch %s: %s", batch_id, e)
+            raise HTTPException(status_code=503, detail="AI service unavailable")
+
+    async def _get_batch_requirements(self, batch: Batch) -> List[str]:
+        """Read the requirements a batch was submitted with back from its input file"""
+        batch_input = await self.client.files.content(batch.input_file_id)
+        first_line = batch_input.text.split("\n", 1)[0]
+        for message in json.loads(first_line)["body"]["messages"]:
+            if message["role"] == "user" and message["content"].startswith(_REQUIREMENTS_PREFIX):
+                return json.loads(message["content"][len(_REQUIREMENTS_PREFIX):])
+        raise ValueError(f"No requirements found in input of batch {batch.id}")
 
+    async def get_batch_results(self, batch: Batch) -> Tuple[List[str], List[Tuple[Dict[str, str], Dict[str, int]]]]:
+        """Parse candidate info and scores from a completed batch, in upload order
+
+        Returns the requirements the batch was submitted with alongside the results.
+        """
+        if not batch.output_file_id:
+            # Every request failed; details are only in the error file
+            logger.error("Batch %s has no output, error file %s", batch.id, batch.error_file_id)
+            raise HTTPException(status_code=500, detail="Batch completed without valid results")
+
+        job_requirements = await self._get_batch_requirements(batch)
+        output = await self.client.files.content(batch.output_file_id)
+        response_model = analysis_model(tuple(job_requirements))
+
+        results = {}
+        for line in output.text.splitlines():
+            if not line.strip():
+                continue
             try:
-                score_text = self._call_openai(messages)
-                score = min(5, max(0, int(score_text)))
-                scores[req] = score
-                total += score
+                item = json.loads(line)
+                response = item.get("response") or {}
+                if item.get("error") or response.get("status_code") != 200:
+                    raise ValueError(item.get("error") or f"status {response.get('status_code')}")
+                content = response["body"]["choices"][0]["message"]["content"]
+                data = response_model.model_validate_json(content)
+                index = int(item["custom_id"].split("-")[-1])
+                results[index] = (self._parse_candidate(data.candidate), self._parse_scores(data.scores, job_requirements))
             except Exception as e:
-                logger.warning(f"Failed to score requirement '{req}': {e}")
-                scores[req] = 0
+                logger.warning("Skipping batch result: %s", e)
 
-        scores["total_score"] = total
-        return scores
+        return job_requirements, [results[i] for i in sorted(results)]
 
     async def extract_requirements(self, job_desc: str) -> List[str]:
         """Get key requirements from job description"""
         messages = [
-            {
-                "role": "system",
-                "content": "Extract specific, measurable job requirements. Focus on technical skills, experience, and qualifications."
-            },
-            {
-                "role": "user",
-                "content": f"List the main requirements from this job post. Return as JSON array of strings.\n\n{job_desc[:10000]}"
-            }
+            {"role": "system", "content": REQUIREMENTS_SYSTEM},
+            {"role": "user", "content": self._truncate(job_desc, settings.MAX_JD_TOKENS)}
         ]
 
         try:
-            response = self._call_openai(messages, json_response=True)
-            data = json.loads(response)
-            
-            # Clean and validate requirements
-            reqs = []
-            for req in data.get("requirements", [])[:settings.MAX_CRITERIA]:
-                if isinstance(req, str) and len(req.strip()) > 10:
-                    reqs.append(req.strip())
-            
-            if not reqs:
-                raise ValueError("No valid requirements found")
-            
-            return reqs
-            
+            return await self._call_openai(messages, response_model=RequirementList, validator=self._clean_requirements)
         except Exception as e:
-            logger.error(f"Failed to extract requirements: {e}")
+            logger.error("Failed to extract requirements: %s", e)
             raise HTTPException(
                 status_code=500,
                 detail="Could not process job requirements"
             )
+
+@lru_cache()
+def get_analyzer() -> ResumeAnalyzer:
+    """Shared analyzer so the OpenAI client and its connection pool are reused"""
+    return ResumeAnalyzer()
@@ -1,48 +1,78 @@
 import logging
-from typing import List, Dict
+from functools import lru_cache
+from typing import List, Dict, Optional, Tuple
 from fastapi import UploadFile, HTTPException
-from pypdf import PdfReader
-from docx import Document
 from io import BytesIO
+import zipfile
 from app.core.config import get_settings
 
 logger = logging.getLogger(__name__)
 settings = get_settings()
 
+WORD_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+def _extract_docx_text(content: bytes) -> str:
+    """Stream paragraph text out of word/document.xml"""
+    from lxml import etree
+
+    paragraphs = []
+    with zipfile.ZipFile(BytesIO(content)) as archive, archive.open("word/document.xml") as f:
+        for _, para in etree.iterparse(f, tag=f"{WORD_NS}p"):
+            text = "".join(t.text for t in para.iter(f"{WORD_NS}t") if t.text)
+            if text.strip():
+                paragraphs.append(text)
+            para.clear()
+    return "\n".join(paragraphs)
+
+def _sniff_kind(content: bytes) -> Optional[str]:
+    """Detect PDF or DOCX from the file's magic bytes"""
+    if content[:5] == b"%PDF-":
+        return "pdf"
+    if content[:4] == b"PK\x03\x04":
+        # Only reads the zip's central directory, not the entries
+        try:
+            with zipfile.ZipFile(BytesIO(content)) as archive:
+                names = archive.namelist()
+        except zipfile.BadZipFile:
+            return None
+        if "word/document.xml" in names:
+            return "docx"
+    return None
+
+def _extract_sync(content: bytes, kind: str) -> str:
+    """Blocking text extraction for PDF or DOCX bytes"""
+    if kind == "pdf":
+        import pdftotext
+        return "\n\n".join(pdftotext.PDF(BytesIO(content)))
+    if kind == "docx":
+        return _extract_docx_text(content)
+    return ""
+
 class TextProcessor:
     @staticmethod
-    async def validate_file(file: UploadFile) -> None:
-        """Validate file type and size"""
-        if file.content_type not in settings.ALLOWED_MIME_TYPES.keys():
+    async def validate_and_read(file: UploadFile) -> Tuple[bytes, str]:
+        """Validate file type and size, returning the content and its kind ("pdf" or "docx")"""
+        content = await file.read()
+        if not content:
             raise HTTPException(
                 status_code=400,
-                detail=f"Unsupported file type: {file.content_type}. Allowed: PDF, DOCX"
+                detail="Empty file"
             )
             
-        content = await file.read()
-        if len(content) == 0:
+        # Check the content itself rather than the client-supplied content type
+        kind = _sniff_kind(content)
+        if kind is None:
             raise HTTPException(
                 status_code=400,
-                detail="Empty file"
+                detail=f"File content is not a valid PDF or DOCX document: {file.filename}"
             )
-        await file.seek(0)  # Reset file pointer
+        return content, kind
 
     @staticmethod
-    async def extract_text(file: UploadFile) -> str:
-        """Extract text from PDF or DOCX files"""
+    def extract_text_from_bytes(content: bytes, kind: str) -> str:
+        """Extract text from PDF or DOCX content. Blocking, run it in a thread"""
         try:
-            content = await file.read()
-            
-            if file.content_type == "application/pdf":
-                reader = PdfReader(BytesIO(content))
-                text = "\n".join(page.extract_text() or "" for page in reader.pages)
-            elif "wordprocessingml.document" in file.content_type:
-                doc = Document(BytesIO(content))
-                text = "\n".join(para.text for para in doc.paragraphs if para.text.strip())
-            else:
-                text = ""
-            
-            await file.seek(0)  # Reset file pointer
+            text = _extract_sync(content, kind)
             
             if not text.strip():
                 raise HTTPException(
@@ -55,8 +85,13 @@ class TextProcessor:
         except HTTPException:
             raise
         except Exception as e:
-            logger.error(f"Text extraction failed: {str(e)}")
+            logger.error("Text extraction failed: %s", e)
             raise HTTPException(
                 status_code=500,
                 detail="Failed to extract text from file"
             )
+
+@lru_cache()
+def get_text_processor() -> TextProcessor:
+    """Shared text processor instance"""
+    return TextProcessor()
@@ -4,14 +4,16 @@ setup(
     name="resume_ranking_api",
     version="0.1.0",
     packages=find_packages(),
+    python_requires=">=3.9",
     install_requires=[
         "fastapi",
         "uvicorn",
         "python-multipart",
-        "openai",
-        "pandas",
-        "python-docx",
-        "pypdf",
+        "openai>=1.40",
+        "tiktoken>=0.7",
+        "regex",
+        "pdftotext",
+        "lxml",
         "pydantic",
         "pydantic-settings",
         "python-dotenv"
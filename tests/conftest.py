@@ -2,6 +2,9 @@ import pytest
 from unittest.mock import patch
 import os
 
+# Settings are loaded when test modules import app.main, before any fixture runs
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+
 @pytest.fixture(autouse=True)
 def mock_settings():
     """Mock settings for all tests"""
@@ -10,6 +13,11 @@ def mock_settings():
         mock.return_value.MAX_FILES = 20
         mock.return_value.MODEL_NAME = "gpt-4"
         mock.return_value.MAX_CRITERIA = 10
+        mock.return_value.MAX_CONCURRENCY = 5
+        mock.return_value.MAX_RESUME_TOKENS = 1500
+        mock.return_value.MAX_JD_TOKENS = 2500
+        mock.return_value.CACHE_DIR = None
+        mock.return_value.LOG_LEVEL = "INFO"
         yield mock
 
 @pytest.fixture(autouse=True)
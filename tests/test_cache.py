@@ -0,0 +1,45 @@
+import pytest
+import os
+from app.services.cache import ResponseCache
+
+@pytest.fixture
+def cache(tmp_path):
+    return ResponseCache(str(tmp_path))
+
+@pytest.fixture
+def sample_messages():
+    return [
+        {"role": "system", "content": "Extract candidate information."},
+        {"role": "user", "content": "John Smith, Python developer"}
+    ]
+
+class TestResponseCache:
+    def test_make_key_is_stable(self, sample_messages):
+        """Should produce the same key for identical inputs"""
+        key1 = ResponseCache.make_key("gpt-4", "1", sample_messages)
+        key2 = ResponseCache.make_key("gpt-4", "1", sample_messages)
+        assert key1 == key2
+
+    def test_make_key_varies_with_inputs(self, sample_messages):
+        """Should change the key when model, prompt version or format changes"""
+        base = ResponseCache.make_key("gpt-4", "1", sample_messages)
+        assert ResponseCache.make_key("gpt-3.5", "1", sample_messages) != base
+        assert ResponseCache.make_key("gpt-4", "2", sample_messages) != base
+        assert ResponseCache.make_key("gpt-4", "1", sample_messages, "ResumeAnalysis") != base
+
+    def test_get_returns_none_on_miss(self, cache):
+        """Should return None for unknown keys"""
+        assert cache.get("missing") is None
+
+    def test_set_then_get(self, cache):
+        """Should return previously stored content"""
+        cache.set("abc", '{"name": "John Smith"}', "gpt-4")
+        assert cache.get("abc") == '{"name": "John Smith"}'
+
+    def test_get_evicts_corrupt_entries(self, cache, tmp_path):
+        """Should evict entries that are not valid JSON"""
+        path = tmp_path / "abc.json"
+        path.write_text("{not json")
+        
+        assert cache.get("abc") is None
+        assert not os.path.exists(path)
@@ -1,11 +1,25 @@
 import pytest
-from unittest.mock import patch, Mock
-from app.services.llm_service import ResumeAnalyzer
+import asyncio
+import json
+from unittest.mock import patch, Mock, AsyncMock
+from app.services.llm_service import ResumeAnalyzer, get_analyzer, load_encoding
+from app.services.cache import ResponseCache
+from app.models.resume import CandidateExtract, RequirementList, RequirementScore, ResumeAnalysis
 from fastapi import HTTPException
+from pydantic import ValidationError
+from openai import LengthFinishReasonError
 
 @pytest.fixture
 def mock_openai():
-    with patch("app.services.llm_service.OpenAI") as mock:
+    with patch("app.services.llm_service.AsyncOpenAI") as mock:
+        yield mock
+
+@pytest.fixture(autouse=True)
+def mock_encoding():
+    """Character-level tokenizer so tests don't download encodings"""
+    with patch("app.services.llm_service._get_encoding") as mock:
+        mock.return_value.encode_ordinary = lambda text: list(text)
+        mock.return_value.decode = lambda ids: "".join(ids)
         yield mock
 
 @pytest.fixture
@@ -27,6 +41,16 @@ def sample_resume():
     - MS in Computer Science
     """
 
+@pytest.fixture
+def sample_candidate():
+    return CandidateExtract(
+        name="John Smith",
+        years_experience="8 years",
+        current_job="Senior Software Engineer",
+        skills="Python, AWS",
+        education="MS in Computer Science"
+    )
+
 @pytest.fixture
 def sample_requirements():
     return [
@@ -44,63 +68,177 @@ class TestResumeAnalyzer:
                 ResumeAnalyzer()
             assert "api key" in str(exc.value).lower()
 
+    def test_get_analyzer_returns_shared_instance(self, mock_openai):
+        """Should reuse one analyzer (and OpenAI client) across requests"""
+        get_analyzer.cache_clear()
+        try:
+            assert get_analyzer() is get_analyzer()
+            mock_openai.assert_called_once()
+        finally:
+            get_analyzer.cache_clear()
+
+    async def test_call_openai_limits_concurrency(self, analyzer):
+        """Should cap in-flight OpenAI calls at MAX_CONCURRENCY across callers"""
+        in_flight = 0
+        peak = 0
+        
+        async def fake_create(**kwargs):
+            nonlocal in_flight, peak
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            response = Mock()
+            response.choices = [Mock()]
+            response.choices[0].message.content = "ok"
+            return response
+        
+        analyzer._semaphore = asyncio.Semaphore(2)
+        with patch.object(analyzer.client.chat.completions, "create", side_effect=fake_create):
+            await asyncio.gather(*(analyzer._call_openai([{"role": "user", "content": str(i)}]) for i in range(6)))
+        
+        assert peak == 2
+
+    async def test_call_openai_uses_cache(self, analyzer, tmp_path):
+        """Should answer repeated calls from the disk cache"""
+        mock_response = Mock()
+        mock_response.choices = [Mock()]
+        mock_response.choices[0].message.content = "cached answer"
+        analyzer.cache = ResponseCache(str(tmp_path))
+        
+        with patch.object(analyzer.client.chat.completions, "create", new_callable=AsyncMock,
+                         return_value=mock_response) as mock_create:
+            first = await analyzer._call_openai([{"role": "user", "content": "test"}])
+            second = await analyzer._call_openai([{"role": "user", "content": "test"}])
+        
+        assert first == second == "cached answer"
+        mock_create.assert_awaited_once()
+
     def test_clean_name_validates_format(self, analyzer):
         """Should properly validate and clean names"""
         # Valid names
         assert analyzer._clean_name("John Smith") == "John Smith"
         assert analyzer._clean_name("Mary Jane Watson") == "Mary Jane Watson"
+        assert analyzer._clean_name("  Mary-Jane O'Neil ") == "Mary-Jane O'Neil"
+        assert analyzer._clean_name("José García") == "José García"
+        assert analyzer._clean_name("John A Smith") == "John A Smith"
+        assert analyzer._clean_name("John A. Smith") == "John A. Smith"
         
         # Invalid names
         assert analyzer._clean_name("john") == "Unknown Candidate"
         assert analyzer._clean_name("123 456") == "Unknown Candidate"
+        assert analyzer._clean_name("john smith") == "Unknown Candidate"
+        assert analyzer._clean_name("John smith") == "Unknown Candidate"
         assert analyzer._clean_name("") == "Unknown Candidate"
 
-    async def test_get_candidate_info_success(self, analyzer, sample_resume):
-        """Should extract candidate info correctly"""
-        mock_response = {
-            "name": "John Smith",
-            "years_experience": "8 years",
-            "current_job": "Senior Software Engineer",
-            "skills": "Python, AWS",
-            "education": "MS in Computer Science"
-        }
-        
-        with patch.object(analyzer, "_call_openai", return_value=str(mock_response)):
-            info = await analyzer.get_candidate_info(sample_resume)
-            assert info["name"] == "John Smith"
-            assert info["experience"] == "8 years"
-            assert "Python" in info["skills"]
+    async def test_load_encoding_loads_tokenizer(self, mock_encoding):
+        """Should load the tokenizer so requests don't download it on the event loop"""
+        await load_encoding()
+        mock_encoding.assert_called_once()
 
-    async def test_get_candidate_info_handles_errors(self, analyzer, sample_resume):
-        """Should handle API errors gracefully"""
-        with patch.object(analyzer, "_call_openai", side_effect=Exception("API Error")):
-            info = await analyzer.get_candidate_info(sample_resume)
-            assert info["name"] == "Unknown Candidate"
-            assert info["experience"] == "Not specified"
+    def test_truncate_limits_tokens(self, analyzer):
+        """Should cut text to the token budget"""
+        assert analyzer._truncate("abcdef", 3) == "abc"
+        assert analyzer._truncate("abc", 10) == "abc"
+
+    def test_truncate_allows_special_tokens(self, analyzer, mock_encoding):
+        """Should treat special token strings in resumes as plain text"""
+        def strict_encode(text):
+            # tiktoken's encode() rejects special tokens by default
+            raise ValueError("Encountered text corresponding to disallowed special token")
+        mock_encoding.return_value.encode = strict_encode
+        
+        assert analyzer._truncate("Hi <|endoftext|> there", 100) == "Hi <|endoftext|> there"
 
-    async def test_score_resume_calculates_correctly(self, analyzer, sample_resume, sample_requirements):
-        """Should score resumes accurately"""
-        mock_scores = {"0": "4", "1": "5", "2": "3"}  # Simulated scores for each requirement
+    async def test_analyze_clamps_scores(self, analyzer, sample_resume, sample_requirements, sample_candidate):
+        """Should clamp scores to 0-5 and total them"""
+        mock_response = ResumeAnalysis(candidate=sample_candidate, scores=[
+            RequirementScore(requirement="5+ years Python experience", score=4),
+            RequirementScore(requirement="AWS certification", score=7),
+            RequirementScore(requirement="Bachelor's degree in CS", score=-2)
+        ])
         
-        with patch.object(analyzer, "_call_openai", side_effect=mock_scores.values()):
-            scores = await analyzer.score_resume(sample_resume, sample_requirements)
+        with patch.object(analyzer, "_call_openai", return_value=mock_response):
+            _, scores = await analyzer.analyze(sample_resume, sample_requirements)
             
             assert len(scores) == len(sample_requirements) + 1  # +1 for total_score
-            assert all(0 <= score <= 5 for req, score in scores.items() if req != "total_score")
-            assert scores["total_score"] == sum(score for req, score in scores.items() if req != "total_score")
+            assert scores["AWS certification"] == 5
+            assert scores["Bachelor's degree in CS"] == 0
+            assert scores["total_score"] == 9
+
+    async def test_analyze_constrains_requirements(self, analyzer, sample_resume, sample_requirements, sample_candidate):
+        """Should only accept scores naming the submitted requirements"""
+        mock_response = ResumeAnalysis(candidate=sample_candidate, scores=[])
+        
+        with patch.object(analyzer, "_call_openai", return_value=mock_response) as mock_call:
+            await analyzer.analyze(sample_resume, sample_requirements)
+        
+        response_model = mock_call.call_args.kwargs["response_model"]
+        response_model.model_validate({
+            "candidate": sample_candidate.model_dump(),
+            "scores": [{"requirement": "AWS certification", "score": 4}]
+        })
+        with pytest.raises(ValidationError):
+            response_model.model_validate({
+                "candidate": sample_candidate.model_dump(),
+                "scores": [{"requirement": "AWS certified", "score": 4}]
+            })
 
-    async def test_score_resume_handles_invalid_scores(self, analyzer, sample_resume, sample_requirements):
-        """Should handle invalid score responses"""
-        with patch.object(analyzer, "_call_openai", return_value="invalid"):
-            scores = await analyzer.score_resume(sample_resume, sample_requirements)
-            assert all(score == 0 for req, score in scores.items() if req != "total_score")
+    def test_parse_scores_logs_missing_requirements(self, analyzer, sample_requirements, caplog):
+        """Should score missing requirements as 0 and log them"""
+        scores = analyzer._parse_scores([RequirementScore(requirement="AWS certification", score=4)], sample_requirements)
+        
+        assert scores["5+ years Python experience"] == 0
+        assert scores["total_score"] == 4
+        assert "5+ years Python experience" in caplog.text
+
+    async def test_analyze_handles_errors(self, analyzer, sample_resume, sample_requirements):
+        """Should surface API errors instead of returning placeholder info"""
+        with patch.object(analyzer, "_call_openai", side_effect=HTTPException(status_code=503)):
+            with pytest.raises(HTTPException) as exc:
+                await analyzer.analyze(sample_resume, sample_requirements)
+            assert exc.value.status_code == 503
+
+    async def test_analyze_returns_candidate_and_scores(self, analyzer, sample_resume, sample_requirements):
+        """Should extract candidate info and scores from one response"""
+        mock_response = ResumeAnalysis(
+            candidate=CandidateExtract(
+                name="John Smith",
+                years_experience="8 years",
+                current_job="Senior Software Engineer",
+                skills="Python, AWS",
+                education=""
+            ),
+            scores=[RequirementScore(requirement="AWS certification", score=4)]
+        )
+        
+        with patch.object(analyzer, "_call_openai", return_value=mock_response) as mock_call:
+            candidate, scores = await analyzer.analyze(sample_resume, sample_requirements)
+            
+            mock_call.assert_called_once()
+            assert candidate["name"] == "John Smith"
+            assert candidate["education"] == "Not specified"
+            assert scores["AWS certification"] == 4
+            assert scores["total_score"] == 4
+
+    def test_analysis_messages_share_prefix_across_resumes(self, analyzer, sample_resume, sample_requirements):
+        """Should keep everything but the resume identical so prompt caching applies"""
+        first = analyzer._analysis_messages(sample_resume, sample_requirements)
+        second = analyzer._analysis_messages("Jane Doe\nData Engineer", sample_requirements)
+        
+        assert first[:-1] == second[:-1]
+        assert first[-1] != second[-1]
+        assert sample_resume.strip() in first[-1]["content"]
 
     async def test_extract_requirements_success(self, analyzer):
         """Should extract requirements correctly"""
         job_desc = "Looking for a senior developer with 5+ years Python experience and AWS certification"
-        mock_response = '{"requirements": ["5+ years Python experience", "AWS certification"]}'
+        mock_response = Mock()
+        mock_response.choices = [Mock()]
+        mock_response.choices[0].message.content = '{"requirements": ["5+ years Python experience", "AWS certification"]}'
+        mock_response.choices[0].message.parsed = RequirementList(requirements=["5+ years Python experience", "AWS certification"])
         
-        with patch.object(analyzer, "_call_openai", return_value=mock_response):
+        with patch.object(analyzer.client.beta.chat.completions, "parse", new_callable=AsyncMock, return_value=mock_response):
             reqs = await analyzer.extract_requirements(job_desc)
             assert len(reqs) == 2
             assert any("Python" in req for req in reqs)
@@ -113,12 +251,115 @@ class TestResumeAnalyzer:
                 await analyzer.extract_requirements("job description")
             assert exc.value.status_code == 500
 
-    def test_call_openai_retries(self, analyzer):
+    async def test_call_openai_retries(self, analyzer):
         """Should retry failed API calls"""
         mock_response = Mock()
+        mock_response.choices = [Mock()]
         mock_response.choices[0].message.content = "Success"
         
-        with patch.object(analyzer.client.chat.completions, "create",
-                         side_effect=[Exception("Timeout"), Exception("Error"), mock_response]):
-            result = analyzer._call_openai([{"role": "user", "content": "test"}])
+        with patch.object(analyzer.client.chat.completions, "create", new_callable=AsyncMock,
+                         side_effect=[Exception("Timeout"), Exception("Error"), mock_response]), \
+             patch("app.services.llm_service.asyncio.sleep", new_callable=AsyncMock) as mock_sleep:
+            result = await analyzer._call_openai([{"role": "user", "content": "test"}])
             assert result == "Success"
+            assert mock_sleep.await_count == 2
+
+    async def test_call_openai_retries_with_feedback(self, analyzer):
+        """Should send validation errors back to the model and retry"""
+        bad_response = Mock()
+        bad_response.choices = [Mock()]
+        bad_response.choices[0].message.content = "not json"
+        good_response = Mock()
+        good_response.choices = [Mock()]
+        good_response.choices[0].message.content = '{"name": "John Smith"}'
+        
+        with patch.object(analyzer.client.chat.completions, "create", new_callable=AsyncMock,
+                         side_effect=[bad_response, good_response]) as mock_create, \
+             patch("app.services.llm_service.asyncio.sleep", new_callable=AsyncMock):
+            result = await analyzer._call_openai(
+                [{"role": "user", "content": "test"}], validator=json.loads
+            )
+            
+            assert result == {"name": "John Smith"}
+            retry_messages = mock_create.call_args_list[1].kwargs["messages"]
+            assert retry_messages[-2] == {"role": "assistant", "content": "not json"}
+            assert "error" in retry_messages[-1]["content"].lower()
+
+    async def test_call_openai_retries_parse_errors_with_feedback(self, analyzer):
+        """Should treat errors raised while parsing the output as invalid output, not outages"""
+        truncated = Mock()
+        truncated.choices = [Mock()]
+        truncated.choices[0].message.content = '{"requirements": ["5+ years'
+        good_response = Mock()
+        good_response.choices = [Mock()]
+        good_response.choices[0].message.content = '{"requirements": ["5+ years Python experience"]}'
+        good_response.choices[0].message.parsed = RequirementList(requirements=["5+ years Python experience"])
+        
+        with patch.object(analyzer.client.beta.chat.completions, "parse", new_callable=AsyncMock,
+                         side_effect=[LengthFinishReasonError(completion=truncated), good_response]) as mock_parse, \
+             patch("app.services.llm_service.asyncio.sleep", new_callable=AsyncMock):
+            result = await analyzer._call_openai([{"role": "user", "content": "test"}], response_model=RequirementList)
+            
+            assert result.requirements == ["5+ years Python experience"]
+            retry_messages = mock_parse.call_args_list[1].kwargs["messages"]
+            assert retry_messages[-2] == {"role": "assistant", "content": '{"requirements": ["5+ years'}
+            assert "error" in retry_messages[-1]["content"].lower()
+
+    async def test_submit_batch_uploads_one_request_per_resume(self, analyzer, sample_resume, sample_requirements):
+        """Should upload a JSONL file with one analysis request per resume"""
+        analyzer.client.files.create = AsyncMock(return_value=Mock(id="file-123"))
+        analyzer.client.batches.create = AsyncMock(return_value=Mock(id="batch-123", status="validating"))
+        
+        batch = await analyzer.submit_batch([sample_resume, sample_resume], sample_requirements)
+        
+        assert batch.id == "batch-123"
+        _, data = analyzer.client.files.create.call_args.kwargs["file"]
+        lines = [json.loads(line) for line in data.decode("utf-8").splitlines()]
+        assert [line["custom_id"] for line in lines] == ["resume-0", "resume-1"]
+        response_format = lines[0]["body"]["response_format"]
+        assert response_format["type"] == "json_schema"
+        assert response_format["json_schema"]["strict"] is True
+        schema = response_format["json_schema"]["schema"]
+        assert schema["additionalProperties"] is False
+        assert schema["$defs"]["RequirementScore"]["properties"]["requirement"]["enum"] == sample_requirements
+        analyzer.client.batches.create.assert_awaited_once()
+
+    async def test_get_batch_results_parses_output(self, analyzer, sample_requirements):
+        """Should parse results in upload order, skip failed requests and recover the requirements"""
+        analysis = ResumeAnalysis(
+            candidate=CandidateExtract(
+                name="John Smith",
+                years_experience="8 years",
+                current_job="Senior Software Engineer",
+                skills="Python, AWS",
+                education="MS in Computer Science"
+            ),
+            scores=[RequirementScore(requirement="AWS certification", score=4)]
+        )
+        input_line = {"custom_id": "resume-0", "body": {"messages": analyzer._analysis_messages("Resume", sample_requirements)}}
+        output_lines = [
+            {"custom_id": "resume-1", "response": {"status_code": 200, "body": {"choices": [{"message": {"content": analysis.model_dump_json()}}]}}, "error": None},
+            {"custom_id": "resume-0", "response": None, "error": {"message": "failed"}}
+        ]
+        files = {
+            "file-123": json.dumps(input_line),
+            "file-456": "\n".join(json.dumps(line) for line in output_lines)
+        }
+        analyzer.client.files.content = AsyncMock(side_effect=lambda file_id: Mock(text=files[file_id]))
+        
+        requirements, results = await analyzer.get_batch_results(Mock(input_file_id="file-123", output_file_id="file-456"))
+        
+        assert requirements == sample_requirements
+        assert len(results) == 1
+        candidate, scores = results[0]
+        assert candidate["name"] == "John Smith"
+        assert scores["total_score"] == 4
+
+    async def test_get_batch_results_fails_without_output(self, analyzer):
+        """Should raise when every request in the batch failed"""
+        analyzer.client.files.content = AsyncMock()
+        
+        with pytest.raises(HTTPException) as exc:
+            await analyzer.get_batch_results(Mock(output_file_id=None, error_file_id="file-789"))
+        assert exc.value.status_code == 500
+        analyzer.client.files.content.assert_not_awaited()
@@ -3,7 +3,23 @@ from fastapi import UploadFile, HTTPException
 from pathlib import Path
 from app.services.text_processor import TextProcessor
 from unittest.mock import Mock, patch
+from starlette.datastructures import Headers
 import io
+import zipfile
+
+DOCX_TYPE = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+DOCX_XML = (
+    '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>'
+    '<w:p><w:r><w:t>John </w:t></w:r><w:r><w:t>Smith</w:t></w:r></w:p>'
+    '<w:p><w:r><w:t>Python developer</w:t></w:r></w:p>'
+    '</w:body></w:document>'
+)
+
+def make_docx(xml: str = DOCX_XML) -> bytes:
+    content = io.BytesIO()
+    with zipfile.ZipFile(content, "w") as archive:
+        archive.writestr("word/document.xml", xml)
+    return content.getvalue()
 
 @pytest.fixture
 def text_processor():
@@ -14,78 +30,106 @@ def sample_pdf():
     content = b"%PDF-1.4\nSample PDF content"
     return UploadFile(
         filename="test.pdf",
-        file=io.BytesIO(content)
+        file=io.BytesIO(content),
+        headers=Headers({"content-type": "application/pdf"})
     )
 
 @pytest.fixture
 def sample_docx():
-    content = b"PK\x03\x04\x14\x00\x00\x00\x08\x00"  # DOCX magic numbers
     return UploadFile(
         filename="test.docx",
-        file=io.BytesIO(content)
+        file=io.BytesIO(make_docx()),
+        headers=Headers({"content-type": DOCX_TYPE})
     )
 
 @pytest.fixture
 def invalid_file():
     return UploadFile(
         filename="test.txt",
-        file=io.BytesIO(b"Some text")
+        file=io.BytesIO(b"Some text"),
+        headers=Headers({"content-type": "text/plain"})
     )
 
 @pytest.fixture
 def empty_file():
     return UploadFile(
         filename="empty.pdf",
-        file=io.BytesIO(b"")
+        file=io.BytesIO(b""),
+        headers=Headers({"content-type": "application/pdf"})
     )
 
 class TestTextProcessor:
-    def test_validate_file_accepts_pdf(self, text_processor, sample_pdf):
-        """Should accept PDF files"""
-        text_processor.validate_file(sample_pdf)  # Should not raise
+    async def test_validate_and_read_accepts_pdf(self, text_processor, sample_pdf):
+        """Should accept PDF files and return their content"""
+        content, kind = await text_processor.validate_and_read(sample_pdf)
+        assert content.startswith(b"%PDF-")
+        assert kind == "pdf"
 
-    def test_validate_file_accepts_docx(self, text_processor, sample_docx):
+    async def test_validate_and_read_accepts_docx(self, text_processor, sample_docx):
         """Should accept DOCX files"""
-        text_processor.validate_file(sample_docx)  # Should not raise
+        content, kind = await text_processor.validate_and_read(sample_docx)
+        assert content.startswith(b"PK\x03\x04")
+        assert kind == "docx"
 
-    def test_validate_file_rejects_invalid_type(self, text_processor, invalid_file):
+    async def test_validate_and_read_rejects_invalid_type(self, text_processor, invalid_file):
         """Should reject files that aren't PDF or DOCX"""
         with pytest.raises(HTTPException) as exc:
-            text_processor.validate_file(invalid_file)
+            await text_processor.validate_and_read(invalid_file)
+        assert exc.value.status_code == 400
+        assert "not a valid pdf or docx" in str(exc.value.detail).lower()
+
+    async def test_validate_and_read_rejects_mislabeled_file(self, text_processor):
+        """Should reject files whose content doesn't match PDF or DOCX"""
+        file = UploadFile(
+            filename="fake.pdf",
+            file=io.BytesIO(b"Not really a PDF"),
+            headers=Headers({"content-type": "application/pdf"})
+        )
+        with pytest.raises(HTTPException) as exc:
+            await text_processor.validate_and_read(file)
+        assert exc.value.status_code == 400
+        assert "not a valid pdf or docx" in str(exc.value.detail).lower()
+
+    async def test_validate_and_read_rejects_non_docx_zip(self, text_processor):
+        """Should reject zip files without word/document.xml"""
+        content = io.BytesIO()
+        with zipfile.ZipFile(content, "w") as archive:
+            archive.writestr("keyword/notes.txt", "word/document.xml")
+        file = UploadFile(
+            filename="fake.docx",
+            file=io.BytesIO(content.getvalue()),
+            headers=Headers({"content-type": DOCX_TYPE})
+        )
+        with pytest.raises(HTTPException) as exc:
+            await text_processor.validate_and_read(file)
         assert exc.value.status_code == 400
-        assert "file type" in str(exc.value.detail).lower()
 
-    def test_validate_file_rejects_empty_file(self, text_processor, empty_file):
+    async def test_validate_and_read_rejects_empty_file(self, text_processor, empty_file):
         """Should reject empty files"""
         with pytest.raises(HTTPException) as exc:
-            text_processor.validate_file(empty_file)
+            await text_processor.validate_and_read(empty_file)
         assert exc.value.status_code == 400
         assert "empty" in str(exc.value.detail).lower()
 
-    @patch("app.services.text_processor.extract_text_from_pdf")
-    def test_extract_text_from_pdf(self, mock_extract, text_processor, sample_pdf):
+    @patch("app.services.text_processor._extract_sync")
+    def test_extract_text_from_pdf(self, mock_extract, text_processor):
         """Should correctly extract text from PDF"""
         expected_text = "Sample extracted text"
         mock_extract.return_value = expected_text
         
-        result = text_processor.extract_text(sample_pdf)
+        result = text_processor.extract_text_from_bytes(b"%PDF-1.4\nSample", "pdf")
         assert result == expected_text
-        mock_extract.assert_called_once()
+        mock_extract.assert_called_once_with(b"%PDF-1.4\nSample", "pdf")
 
-    @patch("app.services.text_processor.extract_text_from_docx")
-    def test_extract_text_from_docx(self, mock_extract, text_processor, sample_docx):
+    def test_extract_text_from_docx(self, text_processor):
         """Should correctly extract text from DOCX"""
-        expected_text = "Sample extracted text"
-        mock_extract.return_value = expected_text
-        
-        result = text_processor.extract_text(sample_docx)
-        assert result == expected_text
-        mock_extract.assert_called_once()
+        result = text_processor.extract_text_from_bytes(make_docx(), "docx")
+        assert result == "John Smith\nPython developer"
 
-    def test_extract_text_handles_errors(self, text_processor, sample_pdf):
+    def test_extract_text_handles_errors(self, text_processor):
         """Should handle extraction errors gracefully"""
-        with patch("app.services.text_processor.extract_text_from_pdf", side_effect=Exception("Extraction failed")):
+        with patch("app.services.text_processor._extract_sync", side_effect=Exception("Extraction failed")):
             with pytest.raises(HTTPException) as exc:
-                text_processor.extract_text(sample_pdf)
+                text_processor.extract_text_from_bytes(b"%PDF-1.4\nSample", "pdf")
             assert exc.value.status_code == 500
             assert "extract" in str(exc.value.detail).lower()